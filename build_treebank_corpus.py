@@ -26,6 +26,7 @@ def build(config: DictConfig):
         treebank_name=config["treebank_name"],
         batch_first=config["batch_first"],
         remove_unique_lemma_scripts=config["remove_unique_lemma_scripts"],
+        n_workers=config["n_workers"],
         include_family=config["include_family"],
         family_level=config["family_level"],
         quality_limit=config["quality_limit"],
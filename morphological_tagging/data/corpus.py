@@ -1,17 +1,19 @@
 import re
+import sys
 import json
 from pathlib import Path
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 from dataclasses import dataclass, field
 from difflib import SequenceMatcher
-from itertools import product
-from typing import Optional, List, Tuple, Dict, Union
+from functools import lru_cache
+from itertools import product, chain
+from multiprocessing import Pool
+from typing import Callable, Iterable, Optional, List, Tuple, Dict, Union
 import pickle
 
 import omegaconf
-import conllu
-from conllu import parse_incr
 import pytorch_lightning as pl
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
@@ -86,14 +88,22 @@ class Tree:
     """A class for holding a single tree.
     """
 
-    raw: List = field(default_factory=lambda: [])
     tokens: List = field(default_factory=lambda: [])
     lemmas: List = field(default_factory=lambda: [])
     morph_tags: List = field(default_factory=lambda: [])
 
+    @property
+    def raw(self):
+        # Derived on demand, rather than storing a duplicate tuple per token
+        return list(zip(self.tokens, self.lemmas, self.morph_tags))
+
     def add_parsed(self, word_form, lemma, morph_tags):
 
-        self.raw.append((word_form, lemma, morph_tags))
+        # Intern the strings, such that repeated forms, lemmas and tags share one object
+        word_form = sys.intern(word_form)
+        lemma = sys.intern(lemma)
+        morph_tags = [sys.intern(t) for t in morph_tags]
+
         self.tokens.append(word_form)
         self.lemmas.append(lemma)
         self.morph_tags.append(morph_tags)
@@ -101,16 +111,13 @@ class Tree:
     def add(self, branch: List):
         _, word_form, lemma, _, _, morph_tags, _, _, _, _ = branch
 
-        self.raw.append((word_form, lemma, morph_tags))
-        self.tokens.append(word_form)
-        self.lemmas.append(lemma)
-        self.morph_tags.append(morph_tags.rsplit(";"))
+        self.add_parsed(word_form, lemma, morph_tags.rsplit(";"))
 
     def __len__(self):
-        return len(self.raw)
+        return len(self.tokens)
 
     def __getitem__(self, i: int):
-        return self.raw[i]
+        return self.tokens[i], self.lemmas[i], self.morph_tags[i]
 
     def __str__(self):
         return f"Tree({self.raw})"
@@ -172,24 +179,6 @@ class Document:
 
         self.lemma_tags_tensor = tags_tensor
 
-    # ! Deprecated method
-    # TODO (ivo): remove
-    def set_word_embeddings(
-        self, word_emb: torch.Tensor, word_vec_type: str = "Undefined"
-    ):
-
-        self.word_emb_type = word_vec_type
-        self.word_emb = word_emb
-
-    # ! Deprecated method
-    # TODO (ivo): remove
-    def set_context_embeddings(
-        self, context_emb: torch.Tensor, model_name: str = "Undefined"
-    ):
-
-        self.model_name = model_name
-        self.context_emb = context_emb
-
     def set_pretrained_embeddings(self, x: torch.Tensor) -> None:
 
         self._pretrained_embeddings = x
@@ -203,6 +192,153 @@ class Document:
             return 0
 
 
+def _doc_to_pt(
+    tokens: List[str],
+    morph_tags: List[List[str]],
+    char_vocab: torchtext.vocab.Vocab,
+    token_vocab: torchtext.vocab.Vocab,
+    morph_tag_vocab: torchtext.vocab.Vocab,
+    morph_cat_vocab: Dict[str, int],
+    morph_tag_cat_vocab: Dict[str, str],
+    char_lut: Optional[np.ndarray] = None,
+) -> Tuple[List[torch.Tensor], torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Converts a single document's characters, tokens and tags to tensors.
+
+    Takes the document's fields rather than the `Document' itself, so that only these
+    need to be pickled when run in a worker process.
+
+    Args:
+        tokens (List[str]): the document's tokens
+        morph_tags (List[List[str]]): the document's morph. tag sets, one per token
+        char_lut (Optional[np.ndarray], optional): char. vocab indices of the 128 ASCII
+            characters. Used in place of the char. vocab for ASCII-only documents. Defaults to None.
+
+    Returns:
+        Tuple[List[torch.Tensor], torch.Tensor, torch.Tensor, torch.Tensor]: the character,
+        token, morph. tag and morph. category tensors, in the order of `Document.set_tensors'
+    """
+
+    # Look up all characters in the document at once, then split per token
+    char_lens = [len(t) for t in tokens]
+    doc_chars = "".join(tokens)
+
+    if char_lut is not None and doc_chars.isascii():
+        # ASCII-only documents index directly into the table by byte value
+        char_ids = char_lut[np.frombuffer(doc_chars.encode("ascii"), dtype=np.uint8)]
+    else:
+        char_ids = np.asarray(
+            char_vocab.lookup_indices(list(doc_chars)), dtype=np.int64
+        )
+
+    # Splits are views onto one storage, and pickling a view writes the whole storage
+    # Clone them, so that each token's tensor only holds its own characters
+    chars_tensor = [
+        c.clone() for c in torch.split(torch.from_numpy(char_ids), char_lens)
+    ]
+
+    # Index lists are converted through numpy, which fills the array in C
+    tokens_tensor = torch.from_numpy(
+        np.asarray(token_vocab.lookup_indices(tokens), dtype=np.int64)
+    )
+
+    # Gather all (token, tag) pairs and fill a multi-hot matrix in one go
+    # Tags not in the vocab (index -1) are skipped
+    # Stored as bool to save memory, cast back to long when collating
+    tagset_lens = [len(tagset) for tagset in morph_tags]
+    cols = np.asarray(
+        morph_tag_vocab.lookup_indices(list(chain.from_iterable(morph_tags))),
+        dtype=np.int64,
+    )
+    rows = np.repeat(np.arange(len(tagset_lens), dtype=np.int64), tagset_lens)
+
+    known = cols != -1
+    rows, cols = rows[known], cols[known]
+
+    morph_tags_tensor = torch.zeros(
+        (len(morph_tags), len(morph_tag_vocab)), dtype=torch.bool
+    ).index_put_(
+        (torch.from_numpy(rows), torch.from_numpy(cols)),
+        torch.ones(len(rows), dtype=torch.bool),
+    )
+
+    morph_cats_tensor = torch.stack(
+        [
+            torch.sum(
+                F.one_hot(
+                    torch.tensor(
+                        list(
+                            {
+                                morph_cat_vocab[morph_tag_cat_vocab[tag.lower()]]
+                                for tag in tagset
+                            }
+                        ),
+                        dtype=torch.long,
+                    ),
+                    len(morph_cat_vocab),
+                ),
+                dim=0,
+            )
+            for tagset in morph_tags
+        ],
+        dim=0,
+    )
+
+    return chars_tensor, tokens_tensor, morph_tags_tensor, morph_cats_tensor
+
+
+@lru_cache(maxsize=2 ** 20)
+def _lemma_script(word_form: str, lemma: str) -> str:
+    """Cached lemma script generation. Word form, lemma pairs repeat a lot within a corpus.
+    """
+
+    return LemmaScriptGenerator(word_form, lemma).get_lemma_script()
+
+
+def _doc_lemma_scripts(tokens: List[str], lemmas: List[str]) -> List[str]:
+    """Generates the lemma script for every (word form, lemma) pair in a document.
+    """
+
+    return [_lemma_script(wf, lm) for wf, lm in zip(tokens, lemmas)]
+
+
+# Per-process state for the corpus preprocessing workers
+# Set once through the pool initializer, so that the vocabs are not pickled per task
+_WORKER_STATE = dict()
+
+
+def _init_worker(state: Dict) -> None:
+    _WORKER_STATE.clear()
+    _WORKER_STATE.update(state)
+
+
+def _doc_to_pt_worker(task: Tuple[int, List[str], List[List[str]]]):
+
+    i, tokens, morph_tags = task
+
+    chars_tensor, tokens_tensor, morph_tags_tensor, morph_cats_tensor = _doc_to_pt(
+        tokens, morph_tags, **_WORKER_STATE
+    )
+
+    # Send back numpy arrays; pickled tensors are moved through shared memory
+    # file descriptors, of which a process can only hold a limited number
+    return (
+        i,
+        (
+            [c.numpy() for c in chars_tensor],
+            tokens_tensor.numpy(),
+            morph_tags_tensor.numpy(),
+            morph_cats_tensor.numpy(),
+        ),
+    )
+
+
+def _doc_lemma_scripts_worker(task: Tuple[int, List[str], List[str]]):
+
+    i, tokens, lemmas = task
+
+    return i, _doc_lemma_scripts(tokens, lemmas)
+
+
 @dataclass
 class DocumentCorpus(Dataset):
     """A class for reading, holding and processing many documents.
@@ -219,6 +355,7 @@ class DocumentCorpus(Dataset):
     max_tokens: int = 256
     max_chars: int = 2048
     remove_unique_lemma_scripts: bool = False
+    n_workers: int = 1
 
     def __len__(self):
         return len(self.docs)
@@ -236,6 +373,74 @@ class DocumentCorpus(Dataset):
 
         self.docs = []
 
+    def iter_connlu_file(self, fp, split: str, name: str, language: str):
+        """Lazily parses a CONLLU file, yielding one document at a time.
+
+        Args:
+            fp (str): path to the CONLLU file
+            split (str): the split the file belongs to (train/dev/test)
+            name (str): the treebank's name
+            language (str): the treebank's language
+
+        Yields:
+            Document: documents within the `max_tokens' and `max_chars' limits
+        """
+
+        # Reading the raw bytes and splitting on tabs avoids the per-line overhead
+        # of a full CONLLU parser; only the used fields are decoded
+        # The file is streamed line by line, so it is never held in memory in full
+        with open(fp, "rb") as f:
+
+            metadata, tree, n_nodes = dict(), Tree(), 0
+            # A trailing empty line ensures the last sentence is flushed
+            for line in chain(f, [b""]):
+                line = line.strip()
+
+                if len(line) == 0:
+                    # End of a sentence
+                    if n_nodes == 0:
+                        metadata = dict()
+                        continue
+
+                    if not (
+                        n_nodes > self.max_tokens
+                        or len(metadata["text"]) > self.max_chars
+                    ):
+                        yield Document(
+                            sent_id=metadata["sent_id"],
+                            text=metadata["text"],
+                            split=split,
+                            language=language,
+                            treebank=name,
+                            tree=tree,
+                        )
+
+                    metadata, tree, n_nodes = dict(), Tree(), 0
+
+                elif line.startswith(b"#"):
+                    # Comment line, only keep `key = value' metadata
+                    key, sep, value = line[1:].partition(b"=")
+                    if sep:
+                        metadata[key.strip().decode("utf-8")] = value.strip().decode(
+                            "utf-8"
+                        )
+
+                else:
+                    n_nodes += 1
+
+                    parts = line.split(b"\t")
+
+                    if b"-" in parts[0] or b"." in parts[0]:
+                        # Throw away all empty nodes and multi-token words
+                        continue
+
+                    # Add to the tree the parsed attributes
+                    tree.add_parsed(
+                        parts[1].decode("utf-8"),
+                        parts[2].decode("utf-8"),
+                        parts[5].decode("utf-8").split(";"),
+                    )
+
     def parse_connlu_file(
         self, fp, split: str, name: str, language: str, remove_duplicates: bool = True
     ):
@@ -249,80 +454,79 @@ class DocumentCorpus(Dataset):
             remove_duplicates (bool, optional): [description]. Defaults to True.
         """
 
-        treebank_docs = []
-
-        with open(fp, "r", encoding="utf-8") as f:
-            for _, tokenlist in enumerate(
-                parse_incr(
-                    f,
-                    fields=[
-                        "id",
-                        "form",
-                        "lemma",
-                        "upos",
-                        "xpos",
-                        "feats",
-                        "head",
-                        "deprel",
-                        "deps",
-                        "misc",
-                    ],
-                    field_parsers={"feats": lambda line, i: line[i].split(";")},
-                )
-            ):
-
-                tree = Tree()
+        docs = self.iter_connlu_file(fp, split, name, language)
 
-                for token in tokenlist:
+        if remove_duplicates:
+            # Keeps the position of the first, but the contents of the last duplicate
+            treebank_docs = dict()
+            for d in docs:
+                treebank_docs[d.text] = d
 
-                    if not isinstance(token["id"], int):
-                        # Throw away all empty nodes and multi-token words
-                        continue
+            self.docs.extend(treebank_docs.values())
 
-                    else:
-                        # Add to the tree the parsed attributes
-                        tree.add_parsed(token["form"], token["lemma"], token["feats"])
+        else:
+            self.docs.extend(docs)
 
-                if (
-                    len(tokenlist) > self.max_tokens
-                    or len(tokenlist.metadata["text"]) > self.max_chars
-                ):
-                    continue
-                else:
-                    doc = Document(
-                        sent_id=tokenlist.metadata["sent_id"],
-                        text=tokenlist.metadata["text"],
-                        split=split,
-                        language=language,
-                        treebank=name,
-                        tree=tree,
-                    )
+    def _map_docs(
+        self, worker_fn: Callable, tasks: Iterable, worker_state: Optional[Dict] = None
+    ):
+        """Applies a per-document worker function over all documents using a process pool.
 
-                    treebank_docs.append(doc)
+        Tasks should only hold plain (string) fields of the documents. Pickling whole
+        `Document' objects would also send their tensors, which torch moves through
+        shared memory file descriptors, of which a process can only hold a limited number.
 
-            if remove_duplicates:
-                treebank_docs = list({d.text: d for d in treebank_docs}.values())
+        Args:
+            worker_fn (Callable): module-level function taking a task tuple, starting with
+                the document index, and returning an `(index, result)' tuple
+            tasks (Iterable): one task tuple per document, in document order
+            worker_state (Optional[Dict], optional): state shared by all tasks, sent to each
+                worker only once. Defaults to None.
+
+        Yields:
+            Tuple[int, Any]: the document index and the worker's result, in document order
+        """
 
-        self.docs.extend(treebank_docs)
+        with Pool(
+            self.n_workers,
+            initializer=_init_worker,
+            initargs=(worker_state if worker_state is not None else dict(),),
+        ) as pool:
+            yield from pool.imap(
+                worker_fn,
+                tasks,
+                chunksize=max(1, len(self.docs) // (self.n_workers * 16)),
+            )
 
     def _set_lemma_tags(self):
 
         self.script_counter, self.script_examples = Counter(), defaultdict(set)
-        docs_scripts, docs_scripts_by_treebank = [], defaultdict(list)
-        for i, d in enumerate(self.docs):
+        docs_scripts, docs_scripts_by_treebank = (
+            [None for _ in self.docs],
+            defaultdict(list),
+        )
 
-            doc_scripts = []
-            for wf, lm in zip(d.tokens, d.lemmas):
+        if self.n_workers <= 1:
+            scripts_iter = (
+                (i, _doc_lemma_scripts(d.tokens, d.lemmas))
+                for i, d in enumerate(self.docs)
+            )
+        else:
+            scripts_iter = self._map_docs(
+                _doc_lemma_scripts_worker,
+                ((i, d.tokens, d.lemmas) for i, d in enumerate(self.docs)),
+            )
 
-                lemma_script = LemmaScriptGenerator(wf, lm).get_lemma_script()
-                self.script_counter[lemma_script] += 1
+        for i, doc_scripts in scripts_iter:
+            d = self.docs[i]
 
-                doc_scripts.append(lemma_script)
+            self.script_counter.update(doc_scripts)
 
+            for wf, lm, lemma_script in zip(d.tokens, d.lemmas, doc_scripts):
                 if len(self.script_examples[lemma_script]) < 3:
                     self.script_examples[lemma_script].add(f"{wf}\u2192{lm}")
 
-            docs_scripts.append(doc_scripts)
+            docs_scripts[i] = doc_scripts
             docs_scripts_by_treebank[d.treebank].extend(doc_scripts)
 
         docs_scripts_by_treebank = dict(docs_scripts_by_treebank)
@@ -369,14 +573,16 @@ class DocumentCorpus(Dataset):
         for i, doc_scripts in enumerate(docs_scripts):
 
             self.docs[i].set_lemma_tags(
-                torch.tensor(
-                    [
-                        self.script_to_id[script]
-                        if script not in self.scripts_disallowed
-                        else -1
-                        for script in doc_scripts
-                    ],
-                    dtype=torch.long,
+                torch.from_numpy(
+                    np.asarray(
+                        [
+                            self.script_to_id[script]
+                            if script not in self.scripts_disallowed
+                            else -1
+                            for script in doc_scripts
+                        ],
+                        dtype=np.int64,
+                    )
                 )
             )
 
@@ -385,29 +591,37 @@ class DocumentCorpus(Dataset):
         # Input vocab is defined based on the train set
         # Reduces vocab sizes and allows for testing behaviour of
         # <UNK> input at validation/test/prediction time
-        train_docs = [self.docs[i] for i in self.splits["train"]]
-
+        # Vocabs are built from generators, to avoid materializing all tokens/chars at once
         self.token_vocab = build_vocab_from_iterator(
-            [[t for t in d.tokens] for d in train_docs],
+            (self.docs[i].tokens for i in self.splits["train"]),
             specials=[self.unk_token, self.pad_token],
             special_first=True,
         )
         self.token_vocab.set_default_index(self.token_vocab[self.unk_token])
 
+        # Iterating over a token string yields its characters
         self.char_vocab = build_vocab_from_iterator(
-            [[c for c in t] for d in train_docs for t in d.tokens],
+            (t for i in self.splits["train"] for t in self.docs[i].tokens),
             specials=[self.unk_token, self.pad_token],
             special_first=True,
         )
         self.char_vocab.set_default_index(self.token_vocab[self.unk_token])
 
+        # Lookup table from ASCII byte value to char vocab index
+        self._char_lut = np.asarray(
+            self.char_vocab.lookup_indices([chr(i) for i in range(128)]),
+            dtype=np.int64,
+        )
+
         # Class vocabs are defined based on the all available data
         # Need the validation and test set to have sensible classes that the model
         # Could theoretically predict into
-        self.morph_tag_vocab = {
-            k: v
-            for v, k in enumerate(
-                sorted(
+        # Torchtext vocab allows for looking up all tags in a document in one call
+        # Unknown tags map to -1, and are skipped when generating tensors
+        self.morph_tag_vocab = torchtext.vocab.vocab(
+            OrderedDict(
+                (tag, 1)
+                for tag in sorted(
                     {
                         tag
                         for d in self.docs
@@ -416,7 +630,8 @@ class DocumentCorpus(Dataset):
                     }
                 )
             )
-        }
+        )
+        self.morph_tag_vocab.set_default_index(-1)
 
         # ======================================================================
         # Morphological feature categories (for regularization)
@@ -518,62 +733,31 @@ class DocumentCorpus(Dataset):
 
     def _move_to_pt(self):
 
-        for d in self.docs:
-            chars_tensor = [
-                torch.tensor(
-                    self.char_vocab.lookup_indices([c for c in t]), dtype=torch.long
-                )
-                for t in d.tokens
-            ]
-
-            tokens_tensor = torch.tensor(
-                self.token_vocab.lookup_indices([t for t in d.tokens]), dtype=torch.long
-            )
-
-            morph_tags_tensor = torch.stack(
-                [
-                    torch.sum(
-                        F.one_hot(
-                            torch.tensor(
-                                [self.morph_tag_vocab.get(tag, "_") for tag in tagset],
-                                dtype=torch.long,
-                            ),
-                            len(self.morph_tag_vocab),
-                        ),
-                        dim=0,
-                    )
-                    for tagset in d.morph_tags
-                ],
-                dim=0,
-            )
+        vocabs = {
+            "char_vocab": self.char_vocab,
+            "token_vocab": self.token_vocab,
+            "morph_tag_vocab": self.morph_tag_vocab,
+            "morph_cat_vocab": self.morph_cat_vocab,
+            "morph_tag_cat_vocab": self.morph_tag_cat_vocab,
+            "char_lut": self._char_lut,
+        }
 
-            morph_cats_tensor = torch.stack(
-                [
-                    torch.sum(
-                        F.one_hot(
-                            torch.tensor(
-                                list(
-                                    {
-                                        self.morph_cat_vocab[
-                                            self.morph_tag_cat_vocab[tag.lower()]
-                                        ]
-                                        for tag in tagset
-                                    }
-                                ),
-                                dtype=torch.long,
-                            ),
-                            len(self.morph_cat_vocab),
-                        ),
-                        dim=0,
-                    )
-                    for tagset in d.morph_tags
-                ],
-                dim=0,
-            )
+        if self.n_workers <= 1:
+            for d in self.docs:
+                d.set_tensors(*_doc_to_pt(d.tokens, d.morph_tags, **vocabs))
 
-            d.set_tensors(
-                chars_tensor, tokens_tensor, morph_tags_tensor, morph_cats_tensor
-            )
+        else:
+            for i, (chars, tokens, morph_tags, morph_cats) in self._map_docs(
+                _doc_to_pt_worker,
+                ((i, d.tokens, d.morph_tags) for i, d in enumerate(self.docs)),
+                vocabs,
+            ):
+                self.docs[i].set_tensors(
+                    [torch.from_numpy(c) for c in chars],
+                    torch.from_numpy(tokens),
+                    torch.from_numpy(morph_tags),
+                    torch.from_numpy(morph_cats),
+                )
 
     def setup(self, generate_tensors: bool = True):
         """Code to run when finished importing all files.
@@ -670,8 +854,11 @@ class DocumentCorpus(Dataset):
             lemma_tags, batch_first=self.batch_first, padding_value=-1
         )
 
+        # Morph tags are stored as bool, and need a signed type for the padding value
         morph_tags = pad_sequence(
-            morph_tags, batch_first=self.batch_first, padding_value=-1
+            [m.long() for m in morph_tags],
+            batch_first=self.batch_first,
+            padding_value=-1,
         )
 
         morph_cats = pad_sequence(
@@ -753,6 +940,7 @@ class TreebankDataModule(pl.LightningDataModule):
         max_chars (int, optional): max number of chars per document. Defaults to 2048.
         remove_duplicates (bool, optional): remove duplicate texts. Defaults to True.
         remove_unique_lemma_scripts (bool, optional): removes lemma scripts with only a single lemma (not recommended). Defaults to False.
+        n_workers (int, optional): number of processes used for generating lemma scripts and tensors. Defaults to 1.
         include_family (bool, optional): includes typological family when searching for CONLLU files (i.e. all Germanic languages). Defaults to False.
         family_level (str, optional): which level to group languages by, `sibling' indicates same family (Dutch -> Germanic), `parent' indicates same genus (Dutch -> Indo-European). Defaults to "sibling".
         quality_limit (float, optional): lower limit of UD quality estimate. See site for more details. Very low values indicate low quality annotations. Defaults to 0.0.
@@ -773,6 +961,7 @@ class TreebankDataModule(pl.LightningDataModule):
         max_chars: int = 2048,
         remove_duplicates: bool = True,
         remove_unique_lemma_scripts: bool = False,
+        n_workers: int = 1,
         include_family: bool = False,
         family_level: str = "sibling",
         quality_limit: float = 0.0,
@@ -799,6 +988,7 @@ class TreebankDataModule(pl.LightningDataModule):
         self.max_chars = max_chars
         self.remove_duplicates = remove_duplicates
         self.remove_unique_lemma_scripts = remove_unique_lemma_scripts
+        self.n_workers = n_workers
         self.batch_size = batch_size
         self.include_family = include_family
         self.family_level = family_level
@@ -904,6 +1094,7 @@ class TreebankDataModule(pl.LightningDataModule):
             max_tokens=self.max_tokens,
             max_chars=self.max_chars,
             remove_unique_lemma_scripts=self.remove_unique_lemma_scripts,
+            n_workers=self.n_workers,
         )
 
         for i, (fp, name, split, language) in enumerate(files):
@@ -943,7 +1134,15 @@ class TreebankDataModule(pl.LightningDataModule):
         if batch_size is None:
             batch_size = self.batch_size
 
+        # Pin the collated batches, so the host to device copy can overlap with compute
+        dataloader_kwargs.setdefault("pin_memory", torch.cuda.is_available())
+
         if use_pytorch:
+            # Keep workers (and their copy of the corpus) alive between epochs
+            if dataloader_kwargs.get("num_workers", 0) > 0:
+                dataloader_kwargs.setdefault("persistent_workers", True)
+                dataloader_kwargs.setdefault("prefetch_factor", 4)
+
             data_loader = DataLoader(
                 corpus,
                 batch_size=batch_size,
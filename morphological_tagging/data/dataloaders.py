@@ -2,6 +2,18 @@ import torch
 from torch.nn.utils.rnn import pad_sequence
 
 
+def _pin_memory(data):
+    """Recursively pins all tensors in a (nested) batch, leaving other objects as is.
+    """
+
+    if isinstance(data, torch.Tensor):
+        return data.pin_memory()
+    elif isinstance(data, (list, tuple)):
+        return type(data)(_pin_memory(d) for d in data)
+    else:
+        return data
+
+
 class TokenDataloader(object):
     """A mock dataloader that batches based on sequence length.
     Total sequence length, and hopefully memory used, should stay constant.
@@ -12,6 +24,8 @@ class TokenDataloader(object):
             max_batch_size (int): _description_
             device (_type_, optional): _description_. Defaults to torch.device("cpu").
             collate_fn (_type_, optional): _description_. Defaults to lambdax:x.
+            pin_memory (bool, optional): pin the collated batches' tensors, such that the host to
+                device copy can be asynchronous. Defaults to False.
         """
 
     def __init__(
@@ -20,12 +34,14 @@ class TokenDataloader(object):
         max_tokens: int,
         max_batch_size: int,
         collate_fn: callable = lambda x: x,
+        pin_memory: bool = False,
     ):
 
         self.dataset = dataset
         self.max_tokens = max_tokens
         self.max_batch_size = max_batch_size
         self.collate_fn = collate_fn
+        self.pin_memory = pin_memory
 
         # Generate batches such that the number of tokens is roughly constant ==
         self._batches = []
@@ -79,6 +95,9 @@ class TokenDataloader(object):
 
         self._index += 1
 
+        if self.pin_memory:
+            return _pin_memory(self.collate_fn(batch))
+
         return self.collate_fn(batch)
 
 
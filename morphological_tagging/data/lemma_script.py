@@ -74,7 +74,8 @@ class LemmaScriptGenerator:
             T = []
 
             for D in range(max_edit + 1):
-                T.append(copy.deepcopy(V))
+                # V only holds ints, so a shallow copy suffices and is far cheaper than deepcopy
+                T.append(V[:])
                 for k in range(-D, D + 1, 2):
                     x = (
                         V[k + 1]
@@ -21,6 +21,17 @@ from morphological_tagging.modules import (
 from utils.errors import ConfigurationError
 
 
+def _morph_tag_stoi(morph_tag_vocab) -> Dict[str, int]:
+    """Gets the tag to index mapping from a corpus' morph tag vocab.
+    Older corpora store this as a plain dict, newer ones as a torchtext vocab.
+    """
+
+    if isinstance(morph_tag_vocab, dict):
+        return morph_tag_vocab
+
+    return morph_tag_vocab.get_stoi()
+
+
 class TorchUDPipe2(nn.Module):
     """A PyTorch implementation of UDPipe2.0.
     For training, I highly recommend using the PyTorch Lightning variant in the `models' package.
@@ -312,7 +323,7 @@ class UDPipe2Pipeline(nn.Module):
 
         self.id_to_lemma_script = deepcopy(dm.corpus.id_to_script)
         self.id_to_morph_tag = deepcopy(
-            {v: k for k, v in dm.corpus.morph_tag_vocab.items()}
+            {v: k for k, v in _morph_tag_stoi(dm.corpus.morph_tag_vocab).items()}
         )
         self.morph_tag_to_morph_cat = deepcopy(dm.corpus.morph_tag_cat_vocab)
         self.char_vocab = deepcopy(dm.corpus.char_vocab)
@@ -877,7 +888,7 @@ class DogTagPipeline(nn.Module):
 
         self.id_to_lemma_script = deepcopy(dm.corpus.id_to_script)
         self.id_to_morph_tag = deepcopy(
-            {v: k for k, v in dm.corpus.morph_tag_vocab.items()}
+            {v: k for k, v in _morph_tag_stoi(dm.corpus.morph_tag_vocab).items()}
         )
         self.morph_tag_to_morph_cat = deepcopy(dm.corpus.morph_tag_cat_vocab)
         self.pad_token = deepcopy(dm.corpus.pad_token)
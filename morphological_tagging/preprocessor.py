@@ -196,9 +196,15 @@ class UDPipe2PreProcessor(nn.Module):
 
     def _word_embeddings(self, token_lens, tokens_raw):
 
+        tokens_flat = [t for seq in tokens_raw for t in seq]
+
+        # Only look up each unique token once, then gather the vectors per token
+        unique_tokens = list(dict.fromkeys(tokens_flat))
+        token_to_row = {t: i for i, t in enumerate(unique_tokens)}
+
         word_embeddings_ = self.vecs.get_vecs_by_tokens(
-            [t for seq in tokens_raw for t in seq], self.lower_case_backup
-        )
+            unique_tokens, self.lower_case_backup
+        )[torch.tensor([token_to_row[t] for t in tokens_flat], dtype=torch.long)]
 
         beg = 0
         word_embeddings = []
@@ -228,26 +234,25 @@ class UDPipe2PreProcessor(nn.Module):
         # Get the word-piece context embedding
         if self.layer_pooling == "average":
             # Pool using layer average
-            wp_ce = torch.mean(
-                torch.stack(
-                    transformer_output.hidden_states[-self.n_layers_pooling :], dim=2
-                ),
-                dim=2,
-            )
+            # Accumulated in place, avoiding a stacked [B, T, L, D] intermediate
+            hidden_states = transformer_output.hidden_states[-self.n_layers_pooling :]
+
+            wp_ce = hidden_states[0].clone()
+            for h in hidden_states[1:]:
+                wp_ce.add_(h)
+            wp_ce.div_(len(hidden_states))
 
         # Pool the wordpiece embeddings into token embeddings
         if self.wordpiece_pooling == "first":
             # Pool using only the first wordpiece
 
-            token_map = [
-                torch.logical_and(
-                    transformer_input["offset_mapping"][i, :, 0]
-                    == 0,  # Only keep the first BPE, i.e. those with non-zero span start
-                    transformer_input["offset_mapping"][i, :, 1]
-                    != 0,  # Remove [CLS], [END], [PAD] tokens, i.e. those with zero span end
-                )
-                for i in range(len(tokens_raw))
-            ]
+            # Computed for the whole batch at once, [B, T_wp]
+            token_map = torch.logical_and(
+                transformer_input["offset_mapping"][:, :, 0]
+                == 0,  # Only keep the first BPE, i.e. those with non-zero span start
+                transformer_input["offset_mapping"][:, :, 1]
+                != 0,  # Remove [CLS], [END], [PAD] tokens, i.e. those with zero span end
+            )
 
             context_embeddings = [
                 wp_ce[i, token_map[i], :] for i in range(len(tokens_raw))